@@ -1,16 +1,20 @@
 import sys
+import csv
 import glob
 import numpy as np
+from math import prod
 import argparse as ap
-from os import getenv
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import getenv, scandir, getpid, cpu_count
 import astropy.units as u
 from zoneinfo import ZoneInfo
-from astropy.time import Time
-from astroplan import Observer
+from astropy.time import Time, TimeDelta
+from astropy.utils import iers
 from os.path import basename, join, isfile, isdir
-from astropy.io.fits import getheader
-from datetime import datetime, timezone
-from astropy.coordinates import EarthLocation, Angle, SkyCoord
+from astropy.io import fits
+from datetime import timezone
+from astropy.coordinates import EarthLocation, Angle, SkyCoord, AltAz
 
 ###
 ### CONSTANTS
@@ -48,6 +52,20 @@ IMAGES_PATH = getenv('IMGPATH')
 T80S_TZ_STR = 'America/Santiago'
 T80S_TZ = ZoneInfo(T80S_TZ_STR)
 UTC_TZ = timezone.utc
+# IERS Earth orientation table is not downloaded in the middle of a run 
+# (set IERS_AUTO_DOWNLOAD=1 to allow astropy to refresh it)
+IERS_AUTO_DOWNLOAD = getenv('IERS_AUTO_DOWNLOAD') in ('1', 'true', 'True')
+# Number of files transformed to AltAz in a single vectorized call
+BATCH_NFILES = 64
+
+def setup_iers():
+    """
+    Configures and preloads the IERS table. Called at the script start 
+    (and by each pool worker), not at import.
+    """
+    iers.conf.auto_download = IERS_AUTO_DOWNLOAD
+    iers.conf.iers_degraded_accuracy = 'warn'
+    iers.IERS_Auto.open()
 
 def parse_arguments():
     parser = ap.ArgumentParser(prog=__script_name__, description=__script_desc__)
@@ -69,6 +87,9 @@ def parse_arguments():
     parser.add_argument('--get_from_az', 
                         action='store_true', default=False, 
                         help='Get datetime from Azimuth fit instead from the Altitude (UNSTABLE).')  
+    parser.add_argument('--jobs', '-j', 
+                        metavar='N', default=None, type=int, 
+                        help='Number of parallel processes used with --date. Defaults to the number of CPUs.')
     time_range_help = 'Creates the timeline centred in header card used to retrieve the datetime. '
     time_range_help += 'Example: -T -100 100 will create a timeline of 200 seconds centered in header '
     time_range_help += 'card used to retrieve the datetime. Defaults to -100 100.'
@@ -93,147 +114,388 @@ def parse_arguments():
             print(f'{__script_name__}: {args.imgdir}: directory does not exists')
             sys.exit(1)
         args.imgwildcard = join(args.imgdir, '*.fits.fz')
-        args.imgglob = glob.glob(args.imgwildcard)
+        # same match as glob(imgwildcard), skipping the bias and skyflat 
+        # frames (not implemented, see --filename)
+        with scandir(args.imgdir) as it:
+            entries = [
+                entry for entry in it
+                if entry.name.endswith('.fits.fz') and not entry.name.startswith('.')
+                and ('bias' not in entry.name) and ('skyflat' not in entry.name)
+            ]
+        # most recently written (cache-warm) files first
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        args.imgglob = [entry.path for entry in entries]
         nfiles = len(args.imgglob)
         if nfiles == 0:
             print(f'{__script_name__}: {args.imgwildcard}: files not found')
             sys.exit(1)
     return args
 
-def get_altaz_dt_new(filename, dt_card=None):
+def _read_header(filename, ext=1):
     """
-    TODO: Need HELP! 
+    Reads only the header of HDU `ext` from the raw FITS blocks, seeking 
+    over the data of the HDUs before it. No data is touched and, for the 
+    .fits.fz files, the fpack (CompImageHDU) machinery is skipped: the 
+    needed cards are copied as-is in the compressed table header.
     """
-    import pytz
+    with open(filename, 'rb') as fileobj:
+        for _ in range(ext):
+            hdr = fits.Header.fromfile(fileobj)
+            naxis = hdr.get('NAXIS', 0)
+            if naxis > 0:
+                nbytes = abs(hdr['BITPIX'])//8*hdr.get('GCOUNT', 1)*(
+                    hdr.get('PCOUNT', 0) + prod(hdr[f'NAXIS{i}'] for i in range(1, naxis + 1))
+                )
+                fileobj.seek(-(-nbytes//2880)*2880, 1)
+        hdr = fits.Header.fromfile(fileobj)
+    return hdr
 
-    # HEADER
-    hdr = getheader(filename, 1)
+@lru_cache
+def _build_location(lat_str, lon_str, hei):
+    """
+    Builds the telescope EarthLocation from the header GEOLAT, GEOLON and 
+    GEOELEV cards. Cached by the header strings, so files from the same 
+    telescope share the same object.
+    """
+    t80s_lat = Angle(lat_str, 'deg')
+    t80s_lon = Angle(lon_str, 'deg')
+    t80s_hei = float(hei)*u.m
+    return EarthLocation(lat=t80s_lat, lon=t80s_lon, height=t80s_hei)
+
+def _header_location(hdr):
+    return _build_location(
+        hdr.get('HIERARCH T80S TEL GEOLAT'),  #'-30.1678638889 degrees'
+        hdr.get('HIERARCH T80S TEL GEOLON'),  #'-70.8056888889 degrees'
+        hdr.get('HIERARCH T80S TEL GEOELEV'),  #2187
+    )
+
+def _poly2_invert(x, y, target):
+    """
+    Least-squares parabola y(x) over the (few) samples x, y evaluated at 
+    target, i.e. np.polyval(np.polyfit(x, y, 2), target) solved in closed 
+    form (Cramer's rule on the 3x3 normal equations). x is centred on 
+    target to keep the normal equations well conditioned, so the value 
+    at target is the constant term.
+    """
+    n = 0
+    sx = sx2 = sx3 = sx4 = sy = sxy = sx2y = 0.0
+    for xi, yi in zip(x, y):
+        xi = float(xi) - target
+        yi = float(yi)
+        xi2 = xi*xi
+        n += 1
+        sx += xi
+        sx2 += xi2
+        sx3 += xi2*xi
+        sx4 += xi2*xi2
+        sy += yi
+        sxy += xi*yi
+        sx2y += xi2*yi
+    det = sx4*(sx2*n - sx*sx) - sx3*(sx3*n - sx*sx2) + sx2*(sx3*sx - sx2*sx2)
+    if det == 0.0:
+        return sy/n
+    return (sx4*(sx2*sy - sx*sxy) - sx3*(sx3*sy - sxy*sx2) + sx2y*(sx3*sx - sx2*sx2))/det
+
+def _is_bracketed(alts, target):
+    """
+    True where the 3 samples alts[..., :3] are strictly monotonic and 
+    target lies between the first and the last one.
+    """
+    a0, a1, a2 = alts[..., 0], alts[..., 1], alts[..., 2]
+    is_monotonic = (a1 - a0)*(a2 - a1) > 0
+    return is_monotonic & ((a0 - target)*(a2 - target) <= 0)
 
-    # LOCATION
-    T80S_LAT = hdr.get('HIERARCH T80S TEL GEOLAT')  #'-30.1678638889 degrees'
-    T80S_LON = hdr.get('HIERARCH T80S TEL GEOLON')  #'-70.8056888889 degrees'
-    T80S_HEI = eval(hdr.get('HIERARCH T80S TEL GEOELEV'))  #2187
-    t80s_lat = Angle(T80S_LAT, 'deg')
-    t80s_lon = Angle(T80S_LON, 'deg')
-    t80s_hei = T80S_HEI*u.m
-    t80s_EL = EarthLocation(lat=t80s_lat, lon=t80s_lon, height=t80s_hei)
-    t80s_tz = pytz.timezone(T80S_TZ_STR)
+def _nearest_sign_change(d, offsets):
+    """
+    Index j of the interval [j, j + 1] of the last axis where d changes
+    sign with the smallest |offset| (midpoint), i.e. the crossing closest
+    to DATE-OBS. `offsets` broadcasts against d. Also returns whether any
+    sign change was found.
+    """
+    crosses = d[..., :-1]*d[..., 1:] <= 0
+    mid = np.abs(offsets[..., :-1] + offsets[..., 1:])
+    dist = np.where(crosses, mid, np.inf)
+    j = dist.argmin(axis=-1)
+    return j, crosses.any(axis=-1)
 
-    t80s_obs = Observer(location=t80s_EL, timezone=t80s_tz)
+def _batch_alts(t_centers, ras, decs, offsets_sec, location):
+    """
+    Altitudes (deg) of the targets ras, decs (deg) at t_centers + offsets_sec,
+    computed with a single AltAz transform. offsets_sec is either the same 
+    offsets for every file (1-D) or one row of offsets per file (2-D). 
+    Returns an array with shape (len(t_centers), number of offsets).
+    """
+    # (n_files, 1) targets broadcast against (n_files, time_n) obstimes
+    all_times = t_centers[:, None] + offsets_sec*u.s
+    all_coords = SkyCoord(ra=ras*u.deg, dec=decs*u.deg)[:, None]
+    altaz_frame = AltAz(obstime=all_times, location=location, pressure=0)
+    aa = all_coords.transform_to(altaz_frame)
+    return aa.alt.deg
+
+def get_altaz_dt_batch(filenames, dt_card=None, location=None):
+    """
+    Vectorized version of `get_altaz_dt_new` for a list of files from the 
+    same telescope: the timelines of all files are transformed to AltAz in 
+    a single call. Returns the csv rows in the same order as filenames.
 
-    # DATETIME
+    `location` can be passed pre-built (see `main_date`) to skip reading 
+    it from the header.
+    """
     if dt_card is None:
         dt_card = 'DATE-OBS'
-    dt_obs = pytz.utc.localize(datetime.fromisoformat(hdr.get(dt_card)))
-    t80s_Time = t80s_obs.datetime_to_astropy_time(dt_obs)
 
-    # TARGET
-    target_coords = SkyCoord(ra=hdr.get('CRVAL1'), dec=hdr.get('CRVAL2'), unit=(u.deg, u.deg))
-    try:
-        _alt = hdr.get('ALT', None)
-    except:
-        _alt = hdr.get('HIERARCH T80S TEL EL START', None)
-    if _alt is None:
-        return f'{filename},{hdr.get("OBJECT")},{hdr.get("FILTER")},None,None'
-    
-    target_input_alt = Angle(_alt, 'deg')
-
-    _times = []
-    _difftimes = []
-    for _T in [t80s_Time-10*u.min, t80s_Time, t80s_Time+10*u.min]:
-        rtime = t80s_obs.target_rise_time(
-            _T,
-            target_coords,
-            horizon=target_input_alt,
-            which='nearest',
-            n_grid_points=1800,
-        )
-        _times.append(rtime)
-        _difftimes.append((rtime - t80s_Time).sec)
-        stime = t80s_obs.target_set_time(
-            _T,
-            target_coords,
-            horizon=target_input_alt,
-            which='nearest',
-            n_grid_points=1800,
-        )
-        _times.append(stime)
-        _difftimes.append((stime - t80s_Time).sec)
-    i_min = np.argmin(np.abs(_difftimes)) 
-    target_dt_utc = _times[i_min].datetime
-    diff_time = _difftimes[i_min]
-    final_message = f'{filename},{hdr.get("OBJECT")},{hdr.get("FILTER")},{target_dt_utc},{diff_time}'
-
-    return final_message
+    # TIMELINE: coarse 10 s step over the whole window, then a 1 s step over 
+    # +-10 s around the coarse interval bracketing the crossing, where the 
+    # quadratic refine over 5 samples recovers the sub-second crossing
+    timeline_sec = np.linspace(-600, 600, 121)
+    fine_sec = np.linspace(-10, 10, 21)
+    fine_n = fine_sec.size
+
+    # HEADERS
+    rows = [None]*len(filenames)
+    i_files, dates, ras, decs, target_alts = [], [], [], [], []
+    for i_file, filename in enumerate(filenames):
+        hdr = _read_header(filename)
+
+        # LOCATION
+        if location is None:
+            location = _header_location(hdr)
+
+        # TARGET ALT
+        try:
+            _alt = hdr.get('ALT', None)
+        except:
+            _alt = hdr.get('HIERARCH T80S TEL EL START', None)
+        if _alt is None:
+            rows[i_file] = (filename, hdr.get('OBJECT'), hdr.get('FILTER'), None, None)
+            continue
+
+        # DATETIME
+        i_files.append(i_file)
+        dates.append(hdr[dt_card])
+        ras.append(hdr.get('CRVAL1'))
+        decs.append(hdr.get('CRVAL2'))
+        target_alts.append(Angle(_alt, 'deg').deg)
+        rows[i_file] = (filename, hdr.get('OBJECT'), hdr.get('FILTER'))
+
+    n_files = len(i_files)
+    if n_files == 0:
+        return rows
+
+    # one array per header field, parsed once for all files
+    t_centers = Time(dates, scale='utc', format='isot', location=location)
+    ras = np.asarray(ras, dtype=float)
+    decs = np.asarray(decs, dtype=float)
+    target_alts = np.asarray(target_alts)
+    diff_times = np.empty(n_files)
+
+    # FAST PATH: header altitude crossed within 1 second of DATE-OBS, i.e. 
+    # bracketed by the (monotonic) samples at -1, 0, +1 s, so the crossing 
+    # is interpolated from them
+    near_sec = np.array([-1.0, 0.0, 1.0])
+    near_alts = _batch_alts(t_centers, ras, decs, near_sec, location)
+    is_near = _is_bracketed(near_alts, target_alts)
+    for k in np.flatnonzero(is_near):
+        diff_times[k] = _poly2_invert(near_alts[k], near_sec, target_alts[k])
+
+    # FULL TIMELINE for the others
+    k_far = np.flatnonzero(~is_near)
+    if k_far.size > 0:
+        t_far = t_centers[k_far]
+        ras_far = ras[k_far]
+        decs_far = decs[k_far]
+        target_far = target_alts[k_far, None]
+
+        # COARSE CROSSING closest to DATE-OBS (one reduction for all files).
+        # Near the meridian the altitude is crossed twice within the window,
+        # the nearest sample alone may pick the other side.
+        all_alts = _batch_alts(t_far, ras_far, decs_far, timeline_sec, location)
+        j, found = _nearest_sign_change(all_alts - target_far, timeline_sec)
+
+        # FINE CROSSING around the bracketing coarse interval
+        all_fine_sec = timeline_sec[j, None] + 5 + fine_sec
+        all_alts = _batch_alts(t_far, ras_far, decs_far, all_fine_sec, location)
+        j, found_fine = _nearest_sign_change(all_alts - target_far, all_fine_sec)
+        found &= found_fine
+        i_ini = np.clip(j - 1, 0, fine_n - 5)
+
+        # SUB-SECOND QUADRATIC REFINE
+        for alts, offsets, i, k in zip(all_alts, all_fine_sec, i_ini, k_far):
+            diff_times[k] = _poly2_invert(alts[i:i + 5], offsets[i:i + 5], target_alts[k])
+
+        # header altitude not crossed inside the window: no value is better
+        # than one extrapolated from the edge samples
+        diff_times[k_far[~found]] = np.nan
+
+    is_found = ~np.isnan(diff_times)
+    targets_dt_utc = np.full(n_files, None)
+    targets_dt_utc[is_found] = (t_centers[is_found] + diff_times[is_found]*u.s).datetime
+    for i_file, target_dt_utc, diff_time in zip(i_files, targets_dt_utc, diff_times):
+        if target_dt_utc is None:
+            rows[i_file] += (None, None)
+        else:
+            rows[i_file] += (target_dt_utc, float(diff_time))
+
+    return rows
+
+def get_altaz_dt_new(filename, dt_card=None, location=None):
+    """
+    TODO: Need HELP! 
+
+    Single file call to `get_altaz_dt_batch`. Returns the csv row 
+    (FILENAME, OBJECT, FILTER, DATETIME, DIFFTIME).
+    """
+    return get_altaz_dt_batch([filename], dt_card=dt_card, location=location)[0]
+
+def _nearest_crossing(x, y, x0, y_ref):
+    """
+    y at x0, from the sign change of x - x0 closest to y_ref (e.g. the 
+    timeline index of DATE-OBS, x is crossed twice around a culmination) 
+    refined with a parabola through the bracketing samples and the next 
+    one. When those 3 samples are not strictly monotonic the inverse 
+    parabola is ill-defined and the bracketing samples are linearly 
+    interpolated instead. Returns None when x0 is not crossed inside the 
+    timeline: the edge samples are not extrapolated.
+    """
+    j, found = _nearest_sign_change(x - x0, y - y_ref)
+    if not found:
+        return None
+    if x[j + 1] == x[j]:
+        return y[j]
+    y_lin = y[j] + (x0 - x[j])*(y[j + 1] - y[j])/(x[j + 1] - x[j])
+    i = min(j, x.size - 3)
+    if (x[i + 1] - x[i])*(x[i + 2] - x[i + 1]) <= 0:
+        return y_lin
+    y0 = _poly2_invert(x[i:i + 3], y[i:i + 3], x0)
+    return min(max(y0, y[j]), y[j + 1])
+
+@lru_cache(maxsize=8)
+def _offset_seconds(tmin, tmax):
+    """
+    Timeline offsets (1 second step) from tmin to tmax, as a TimeDelta so 
+    adding it to a Time skips the Quantity conversion. Cached, since 
+    time_range is the same for a whole batch. Do not modify in place.
+    """
+    return TimeDelta(np.linspace(tmin, tmax, tmax - tmin + 1), format='sec')
+
+@lru_cache(maxsize=8)
+def _timeline_lin(time_n):
+    return np.arange(time_n, dtype=np.float64)
+
+_FIG_CACHE = None
+
+def _get_figure():
+    """
+    Returns the ALT/AZ plot figure and axes, cleared. The figure is created 
+    (and matplotlib imported, with the non-interactive Agg backend since 
+    only PNGs are saved) on the first call and reused afterwards.
+    """
+    global _FIG_CACHE
+    if _FIG_CACHE is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot as plt
+
+        f, (axalt, axaz) = plt.subplots(1, 2)
+        f.set_size_inches(10, 5)
+        _FIG_CACHE = f, (axalt, axaz)
+    f, axes = _FIG_CACHE
+    for ax in axes:
+        ax.clear()
+    return f, axes
 
 def get_altaz_dt(filename, get_from_az=False, plot=False, time_range=[-100, 1000], dt_card=None, debug=False):
     """
     TODO: Need HELP! 
     """
     # HEADER
-    hdr = getheader(filename, 1)
+    hdr = _read_header(filename)
 
     # LOCATION
-    T80S_LAT = hdr.get('HIERARCH T80S TEL GEOLAT')  #'-30.1678638889 degrees'
-    T80S_LON = hdr.get('HIERARCH T80S TEL GEOLON')  #'-70.8056888889 degrees'
-    T80S_HEI = eval(hdr.get('HIERARCH T80S TEL GEOELEV'))  #2187
-    t80s_lat = Angle(T80S_LAT, 'deg')
-    t80s_lon = Angle(T80S_LON, 'deg')
-    t80s_hei = T80S_HEI*u.m
-    t80s_EL = EarthLocation(lat=t80s_lat, lon=t80s_lon, height=t80s_hei)
+    t80s_EL = _header_location(hdr)
 
     # DATETIME
     if dt_card is None:
         dt_card = 'DATE-OBS'
-    str_dt_obs = hdr.get(dt_card) + '+00:00'
-    dt_obs = datetime.fromisoformat(str_dt_obs)
-    t80s_dt = dt_obs.astimezone(T80S_TZ)
-    t80s_Time = Time(t80s_dt, location=t80s_EL)
+    t80s_Time = Time(hdr[dt_card], scale='utc', format='isot', location=t80s_EL)
+    dt_obs = t80s_Time.to_datetime(timezone=UTC_TZ)
+
+    # TARGET
+    target_coords = SkyCoord(ra=hdr.get('CRVAL1'), dec=hdr.get('CRVAL2'), unit=(u.deg, u.deg))
+
+    # FAST PATH: header altitude crossed within 1 second of DATE-OBS (the 
+    # timeline is still needed to plot, debug or fit the azimuth)
+    _alt = hdr.get('HIERARCH T80S TEL EL START', None)
+    if (_alt is not None) and not (get_from_az or plot or debug):
+        target_in_alt = Angle(_alt, 'deg')
+        near_sec = _offset_seconds(-1, 1)
+        near_frame = AltAz(obstime=t80s_Time + near_sec, location=t80s_EL, pressure=0)
+        near_alt = target_coords.transform_to(near_frame).alt.deg
+        if _is_bracketed(near_alt, target_in_alt.deg):
+            diff_sec = _poly2_invert(near_alt, near_sec.value, target_in_alt.deg)
+            target_dt_utc = (t80s_Time + diff_sec*u.second).to_datetime(timezone=UTC_TZ)
+            # same microsecond-rounded DIFFTIME as the full timeline below
+            diff_time = (target_dt_utc - dt_obs).total_seconds()
+            final_message = f'{filename},{hdr.get("OBJECT")},{hdr.get("FILTER")},{target_dt_utc},{diff_time}'
+            return final_message, None
 
     # TIMELINE
     tmin, tmax = time_range
     time_n = (tmax - tmin) + 1
-    timeline = t80s_Time + u.second*np.linspace(tmin, tmax, time_n)
-    timeline_lin = np.asarray(list(range(time_n)))
-
-    # OBSERVER
-    t80s_obs = Observer(location=t80s_EL, timezone=T80S_TZ)
-
-    # TARGET
-    target_coords = SkyCoord(ra=hdr.get('CRVAL1'), dec=hdr.get('CRVAL2'), unit=(u.deg, u.deg))
-    target_AltAz = t80s_obs.altaz(timeline, target=target_coords)
-    target_dt_utc = None
+    timeline = t80s_Time + _offset_seconds(tmin, tmax)
+    timeline_lin = _timeline_lin(time_n)
+
+    # ALTAZ FRAME (no refraction: mount ALT/AZ are not refraction corrected)
+    altaz_frame = AltAz(obstime=timeline, location=t80s_EL, pressure=0)
+
+    # TARGET ALTAZ
+    target_AltAz = target_coords.transform_to(altaz_frame)
+    alt_deg = target_AltAz.alt.deg
+    az_deg = target_AltAz.az.deg
+    target_alt_dt_utc = None
+    target_az_dt_utc = None
+    i_alt, i_az = None, None
+    # timeline index of DATE-OBS, the crossings closest to it are used
+    i_obs = -tmin
 
     # TARGET ALT
     _alt = hdr.get('HIERARCH T80S TEL EL START', None)
     if _alt is not None:
         target_in_alt = Angle(_alt, 'deg')
         #target_in_alt = Angle(hdr.get('ALT'), 'deg')
-        p_alt = np.polyfit(target_AltAz.alt.value, timeline_lin, 2)
-        i_alt = int(np.polyval(p_alt, target_in_alt.value))
-        target_alt_Time = timeline[i_alt]
-        target_alt_dt_utc = target_alt_Time.to_datetime().replace(tzinfo=UTC_TZ)
-        target_dt_utc = target_alt_dt_utc
+        i_alt_lin = _nearest_crossing(alt_deg, timeline_lin, target_in_alt.value, i_obs)
+        if i_alt_lin is not None:
+            i_alt = int(i_alt_lin)
+            target_alt_Time = timeline[0] + i_alt_lin*u.second
+            target_alt_dt_utc = target_alt_Time.to_datetime().replace(tzinfo=UTC_TZ)
 
     # TARGET AZ
     _az = hdr.get('HIERARCH T80S TEL AZ START', None)
     if _az is not None:
         target_in_az = Angle(_az, 'deg')
         #target_in_az = Angle(hdr.get('AZ'), 'deg')
-        p_az = np.polyfit(target_AltAz.az.value, timeline_lin, 2)
-        i_az = int(np.polyval(p_az, target_in_az.value))
-        target_az_Time = timeline[i_az]
-        target_az_dt_utc = target_az_Time.to_datetime().replace(tzinfo=UTC_TZ)
-        target_dt_utc = target_az_dt_utc
+        # unwrap the 360 -> 0 deg crossing and move the header AZ to the 
+        # same turn as the timeline centre
+        az_deg = np.rad2deg(np.unwrap(np.deg2rad(az_deg)))
+        target_az_val = target_in_az.value + 360.0*np.round((az_deg[time_n//2] - target_in_az.value)/360.0)
+        i_az_lin = _nearest_crossing(az_deg, timeline_lin, target_az_val, i_obs)
+        if i_az_lin is not None:
+            i_az = int(i_az_lin)
+            target_az_Time = timeline[0] + i_az_lin*u.second
+            target_az_dt_utc = target_az_Time.to_datetime().replace(tzinfo=UTC_TZ)
+
+    diff_time_alt = None
+    if target_alt_dt_utc is not None:
+        diff_time_alt = (target_alt_dt_utc - dt_obs).total_seconds()
+    diff_time_az = None
+    if target_az_dt_utc is not None:
+        diff_time_az = (target_az_dt_utc - dt_obs).total_seconds()
+    if get_from_az:
+        target_dt_utc, diff_time = target_az_dt_utc, diff_time_az
+    else:
+        target_dt_utc, diff_time = target_alt_dt_utc, diff_time_alt
 
     if target_dt_utc is not None:
-        if get_from_az:
-            diff_time_az = (target_az_dt_utc - dt_obs).total_seconds()
-            diff_time = diff_time_az
-        else:
-            diff_time_alt = (target_alt_dt_utc - dt_obs).total_seconds()
-            diff_time = diff_time_alt
-
         # FINAL PRINT
         final_message = f'{filename},{hdr.get("OBJECT")},{hdr.get("FILTER")},{target_dt_utc},{diff_time}'
     else:
@@ -247,53 +509,49 @@ def get_altaz_dt(filename, get_from_az=False, plot=False, time_range=[-100, 1000
         print(f'{diff_time_alt=} {diff_time_az=}')
 
         # ASSERT ALT
-        target_alt_dt_t80s = target_alt_dt_utc.astimezone(T80S_TZ)
-        _tmp = (target_alt_dt_t80s - t80s_dt).total_seconds()
-        assert(diff_time_alt == _tmp)
+        t80s_dt = dt_obs.astimezone(T80S_TZ)
+        if target_alt_dt_utc is not None:
+            target_alt_dt_t80s = target_alt_dt_utc.astimezone(T80S_TZ)
+            _tmp = (target_alt_dt_t80s - t80s_dt).total_seconds()
+            assert(diff_time_alt == _tmp)
 
         # ASSERT AZ
-        target_az_dt_t80s = target_az_dt_utc.astimezone(T80S_TZ)
-        _tmp = (target_az_dt_t80s - t80s_dt).total_seconds()
-        assert(diff_time_az == _tmp)    
+        if target_az_dt_utc is not None:
+            target_az_dt_t80s = target_az_dt_utc.astimezone(T80S_TZ)
+            _tmp = (target_az_dt_t80s - t80s_dt).total_seconds()
+            assert(diff_time_az == _tmp)    
     ##########################################################################################
     
     ##########################################################################################
     # PLOT
     ##########################################################################################
     if (target_dt_utc is not None) & plot:
-        from matplotlib import pyplot as plt
         from matplotlib.dates import DateFormatter
 
-        f, (axalt, axaz) = plt.subplots(1, 2)
-        axalt.plot(timeline.value, target_AltAz.alt)
-        x_timeline = np.polyval(p_alt, target_AltAz.alt.value)
-        i_timeline = x_timeline.astype(int)
-        i_timeline = i_timeline[(i_timeline > 0) & (i_timeline < time_n)]
-        axalt.plot(timeline.value[i_timeline], target_AltAz.alt.value[i_timeline], c='orange', ls='-.')
+        f, (axalt, axaz) = _get_figure()
+        timeline_dt = timeline.datetime
+        axalt.plot(timeline_dt, alt_deg)
         axalt.axhline(y=target_in_alt.value, ls='--', c='k', label=f'{target_in_alt.value}')
-        axalt.axvline(x=timeline.value[i_alt], ls='--', c='b', label=f'{timeline.value[i_alt]}')
+        if i_alt is not None:
+            axalt.axvline(x=timeline_dt[i_alt], ls='--', c='b', label=f'{timeline_dt[i_alt]}')
         axalt.set_ylabel('Altitude [deg]')
-        axaz.plot(timeline.value, target_AltAz.az)
-        x_timeline = np.polyval(p_az, target_AltAz.az.value)
-        i_timeline = x_timeline.astype(int)
-        i_timeline = i_timeline[(i_timeline > 0) & (i_timeline < time_n)]
-        axaz.plot(timeline.value[i_timeline], target_AltAz.az.value[i_timeline], c='orange', ls='-.')
-        axaz.axhline(y=target_in_az.value, ls='--', c='k', label=f'{target_in_az.value}')
-        axaz.axvline(x=timeline.value[i_az], ls='--', c='b', label=f'{timeline.value[i_az]}')
+        axaz.plot(timeline_dt, az_deg)
+        axaz.axhline(y=target_az_val, ls='--', c='k', label=f'{target_in_az.value}')
+        if i_az is not None:
+            axaz.axvline(x=timeline_dt[i_az], ls='--', c='b', label=f'{timeline_dt[i_az]}')
         axaz.set_ylabel('Azimuth [deg]')
         for ax in (axalt, axaz):
             formatter = DateFormatter('%H:%M:%S', tz=T80S_TZ)
             ax.xaxis.set_major_formatter(formatter)
-            plt.setp(ax.get_xticklabels(), rotation=45)      
+            ax.tick_params(axis='x', labelrotation=45)
             ax.set_xlabel('Time')
             ax.legend(frameon=False, loc=1)
-            ax.grid()
-        f.set_size_inches(10, 5)
+            ax.grid(True)
         f.suptitle(hdr.get('TIME'))
         f.tight_layout()
-        image_filename = 'target_alt_az.png'
-        f.savefig(image_filename)
-        plt.close(f)
+        # one file per process (and figure), so parallel runs do not collide
+        image_filename = f'target_alt_az_{getpid()}_{id(f)}.png'
+        f.savefig(image_filename, dpi=72, bbox_inches=None, pil_kwargs={'compress_level': 1})
     else:
         image_filename = None
     ##########################################################################################
@@ -333,7 +591,7 @@ def main_telegram_v13():
             update.message.reply_text('USAGE: /getAltDTDir YYYYMMDD [0/1 PLOT]')
         if ok:
             try:
-                plot = bool(eval(context.args[1]))
+                plot = context.args[1] in ('1', 'true', 'True')
             except:
                 plot = False
 
@@ -367,7 +625,7 @@ def main_telegram_v13():
             update.message.reply_text('USAGE: /getAltDTFile FILENAME [0/1 PLOT]')
         if ok:
             try:
-                plot = bool(eval(context.args[1]))
+                plot = context.args[1] in ('1', 'true', 'True')
             except:
                 plot = False
             if plot:
@@ -392,7 +650,7 @@ def main_telegram_v13():
         except:
             update.message.reply_text('USAGE: /getAzDTDir YYYYMMDD [0/1 PLOT]')
         try:
-            plot = bool(eval(context.args[1]))
+            plot = context.args[1] in ('1', 'true', 'True')
         except:
             plot = False
 
@@ -425,7 +683,7 @@ def main_telegram_v13():
             update.message.reply_text('USAGE: /getAzDTFile FILENAME [0/1 PLOT]')
         if ok:
             try:
-                plot = bool(eval(context.args[1]))
+                plot = context.args[1] in ('1', 'true', 'True')
             except:
                 plot = False
             if plot:
@@ -450,9 +708,9 @@ def main_telegram_v13():
         except:
             update.message.reply_text('USAGE: /getAltAzDTFile FILENAME GET_FROM_AZ PLOT TIME_RANGE HEADERCARD')    
         if ok:
-            get_from_az = bool(eval(get_from_az))
-            plot = bool(eval(plot))
-            time_range = list(eval(time_range))
+            get_from_az = get_from_az in ('1', 'true', 'True')
+            plot = plot in ('1', 'true', 'True')
+            time_range = list(map(int, time_range.split(',')))
             if plot:
                 update.message.reply_text('PLOT ON')
             else:
@@ -498,28 +756,47 @@ def main_telegram_v13():
     updater.start_polling()
     updater.idle()
 
+def _warm_up(location, obstime):
+    """
+    Process pool initializer: one throw-away AltAz transform, so each 
+    worker loads IERS/ERFA before its first batch.
+    """
+    setup_iers()
+    SkyCoord(ra=0*u.deg, dec=0*u.deg).transform_to(AltAz(obstime=obstime, location=location, pressure=0))
+
 def main_date(args):
-    for filename in args.imgglob:
-        final_message = get_altaz_dt_new(
-            filename=filename, 
-            dt_card=args.header_date
-        )
-#        final_message, image_filename = get_altaz_dt(
-#            filename=filename, 
-#            get_from_az=args.get_from_az, 
-#            time_range=args.time_range,
-#            plot=args.plot,
-#        )
-        print(final_message)
+    # LOCATION (same telescope for the whole directory)
+    hdr = _read_header(args.imgglob[0])
+    location = _header_location(hdr)
+    obstime = Time(hdr[args.header_date], scale='utc', format='isot')
+    _get_altaz_dt = partial(
+        get_altaz_dt_batch, 
+        dt_card=args.header_date,
+        location=location,
+    )
+    # files are transformed in batches of at most BATCH_NFILES, small 
+    # enough to give every worker a batch. Batches are independent and 
+    # rows are printed as they finish
+    n_jobs = args.jobs or cpu_count() or 1
+    nfiles = len(args.imgglob)
+    batch_nfiles = max(1, min(BATCH_NFILES, -(-nfiles//n_jobs)))
+    batches = [args.imgglob[i:i + batch_nfiles] for i in range(0, nfiles, batch_nfiles)]
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_warm_up, initargs=(location, obstime)) as executor:
+        futures = [executor.submit(_get_altaz_dt, batch) for batch in batches]
+        for future in as_completed(futures):
+            for row in future.result():
+                writer.writerow(row)
 
 if __name__ == '__main__':
     args = parse_arguments()
+    setup_iers()
 
     if args.telegram:
         main_telegram_v13()
     else:
         if args.filename is not None:
-            final_message = get_altaz_dt_new(
+            row = get_altaz_dt_new(
                 filename=args.filename, 
                 dt_card=args.header_date,
             )
@@ -530,7 +807,7 @@ if __name__ == '__main__':
 #                plot=args.plot,
 #                dt_card=args.header_date,
 #            )
-            print(final_message)
+            csv.writer(sys.stdout, lineterminator='\n').writerow(row)
         elif args.date is not None:
             main_date(args)
 